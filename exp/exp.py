@@ -1,8 +1,31 @@
 import math
+import os
+import sys
+from array import array
 
+import numpy as np
 from myhdl import *
 
 
+def csd_digits(k):
+    """Return the canonical signed-digit form of the integer k.
+
+    The result is a list of (sign, shift) pairs such that
+    k == sum(sign << shift for sign, shift in digits), with no two adjacent
+    nonzero digits.
+    """
+    digits = []
+    shift = 0
+    while k != 0:
+        if k & 1:
+            sign = 2 - (k & 3)
+            digits.append((sign, shift))
+            k -= sign
+        k >>= 1
+        shift += 1
+    return digits
+
+
 class FixedDef:
     """Super-low budget signed fixed-point implementation."""
 
@@ -15,58 +38,196 @@ class FixedDef:
         self.f = f
         self.max_val = 1 << (m + f + 1)
         self.min_val = -self.max_val
+        self.scale = 1 << f
+        self.inv_scale = 1.0 / self.scale
+
+        # Prototype for zero-initialized signals.  Signal() copies its initial
+        # value, so the prototype is never shared between signals.
+        self._zero = intbv(0, min=self.min_val, max=self.max_val)
 
         print "%d.%d (%d, %d)" % (self.m, self.f, self.min_val, self.max_val)
 
-    def make_signal(self, init_value):
+    def make_signal(self, init_value, guard=0):
+        """
+        :param guard: Number of extra bits kept after the radix point.
+        """
+        if guard:
+            return Signal(intbv(init_value, min=self.min_val << guard, max=self.max_val << guard))
+        if init_value == 0:
+            return Signal(self._zero)
         return Signal(intbv(init_value, min=self.min_val, max=self.max_val))
 
-    def fixed_mul(self, z, x, y):
+    def fixed_mul(self, z, x, y, shift=None):
+        """
+        :param shift: Right shift applied to the product, f by default.  Use a
+            different shift when an operand or z carries guard bits.
+        """
+        if shift is None:
+            shift = self.f
+
         @always_comb
         def logic():
             """Return the product of the fixed point inputs x and y via z."""
-            z.next = (x * y) >> self.f
+            z.next = (x * y) >> shift
+
+        return logic
+
+    def fixed_mul_const(self, z, x, c, shift=None):
+        """Multiply the fixed point input x by the constant c via z using only shifts and adds.
+
+        Each nonzero digit of the canonical signed-digit form of c costs one adder,
+        which for short constants is cheaper and faster than a full multiplier.
+        The result is identical to fixed_mul(z, x, to_fixed(c), shift).
+        """
+        if shift is None:
+            shift = self.f
+
+        digits = csd_digits(self.to_fixed(c))
+        if not digits:
+            # c rounds to zero; this still reads x, so always_comb has a sensitivity list.
+            return self.fixed_mul(z, x, 0, shift)
+
+        # The partial sums can grow past the final product, up to |x| << (top digit + 1).
+        bound = self.max_val << (digits[-1][1] + 1)
+
+        insts = []
+        acc = None
+        for sign, digit_shift in digits:
+            partial = Signal(intbv(0, min=-bound, max=bound))
+            insts.append(self._shift_add(partial, acc, x, sign, digit_shift))
+            acc = partial
+
+        @always_comb
+        def logic():
+            z.next = acc >> shift
+
+        insts.append(logic)
+        return insts
+
+    def _shift_add(self, z, acc, x, sign, shift):
+        """Drive z with acc + sign * (x << shift), or just sign * (x << shift) if acc is None."""
+        if acc is None:
+            if sign > 0:
+                @always_comb
+                def logic():
+                    z.next = x << shift
+            else:
+                @always_comb
+                def logic():
+                    z.next = -(x << shift)
+        elif sign > 0:
+            @always_comb
+            def logic():
+                z.next = acc + (x << shift)
+        else:
+            @always_comb
+            def logic():
+                z.next = acc - (x << shift)
 
         return logic
 
     def to_fixed(self, x):
-        """Compute the nearest fixed-point representation of x."""
-        return int(round(x * (1 << self.f)))
+        """Compute the nearest fixed-point representation of x, rounding halves up."""
+        return int(math.floor(x * self.scale + 0.5))
 
     def to_float(self, x):
         """Compute the nearest floating-point representation of fixed-point value x."""
-        return int(x) / float(1 << self.f)
+        return int(x) * self.inv_scale
+
+
+# Taylor coefficients of exp(x) around 0, up to the fourth-order term.
+TAYLOR_COEFFS = (1.0, 1.0, 1.0 / 2, 1.0 / 6, 1.0 / 24)
+
+
+# Extra bits kept after the radix point on the x/6 and x^2/24 partial products.
+# Without them the Estrin grouping rounds x/6 before multiplying by x^2, which
+# is measurably less accurate than summing the power terms.
+ESTRIN_GUARD_BITS = 2
+
 
+def _choose_order(f):
+    """Pick the lowest Taylor order worth using with f bits after the radix point."""
+    return 2 if f <= 4 else (3 if f <= 8 else 4)
 
-def ExpComb(x, y, fixed_def):
-    """Combinatorial implementation of the exponential function."""
+
+def ExpComb(x, y, fixed_def, order=None):
+    """Combinatorial implementation of the exponential function.
+
+    :param order: Order of the Taylor expansion around 0 (2, 3 or 4).  By default
+        it is chosen from the number of fractional bits in fixed_def.
+
+    The expansion is grouped in Estrin form,
+    (1 + x) + x^2 * (1/2 + x/6) + x^2 * (x^2 / 24), so that x^2 and x/6 are
+    computed in parallel and only the terms needed for the order are built.
+    The inner terms carry ESTRIN_GUARD_BITS extra fractional bits, so the
+    worst-case error is no larger than summing 1 + x + x^2/2 + x^3/6 directly.
+    """
+    if order is None:
+        order = _choose_order(fixed_def.f)
+    if order not in (2, 3, 4):
+        raise ValueError("Unsupported Taylor order: %r" % order)
+
+    one = fixed_def.to_fixed(TAYLOR_COEFFS[0])
 
     # Compute x^2.
     x2 = fixed_def.make_signal(0)
     inst_x2 = fixed_def.fixed_mul(x2, x, x)
 
-    # Compute x^3.
-    x3 = fixed_def.make_signal(0)
-    inst_x3 = fixed_def.fixed_mul(x3, x2, x)
+    if order == 2:
+        @always_comb
+        def logic():
+            """Second-order Taylor expansion of the exponential function around 0."""
+            y.next = one + x + (x2 >> 1)
+
+        return instances()
 
-    # Compute 1/6 of x^3.
-    sixth = fixed_def.to_fixed(1.0 / 6)
-    x3_6 = fixed_def.make_signal(0)
-    inst_x3_6 = fixed_def.fixed_mul(x3_6, x3, sixth)
+    f = fixed_def.f
+    g = min(ESTRIN_GUARD_BITS, f)
+    half = fixed_def.to_fixed(TAYLOR_COEFFS[2]) << g
+
+    # Compute 1/6 of x with g guard bits, in parallel with x^2.
+    x_6 = fixed_def.make_signal(0, guard=g)
+    inst_x_6 = fixed_def.fixed_mul_const(x_6, x, TAYLOR_COEFFS[3], shift=f - g)
+
+    # Compute 1/2 + x/6, still with g guard bits.
+    t = fixed_def.make_signal(0, guard=g)
+
+    @always_comb
+    def logic_t():
+        t.next = half + x_6
+
+    # Compute x^2 * (1/2 + x/6), dropping the guard bits.
+    x2_t = fixed_def.make_signal(0)
+    inst_x2_t = fixed_def.fixed_mul(x2_t, x2, t, shift=f + g)
+
+    if order == 3:
+        @always_comb
+        def logic():
+            """Third-order Taylor expansion of the exponential function around 0."""
+            y.next = one + x + x2_t
+
+        return instances()
+
+    # Compute x^4 / 24 as x^2 * (x^2 / 24), in parallel with x^2 * (1/2 + x/6).
+    x2_24 = fixed_def.make_signal(0, guard=g)
+    inst_x2_24 = fixed_def.fixed_mul_const(x2_24, x2, TAYLOR_COEFFS[4], shift=f - g)
+
+    x4_24 = fixed_def.make_signal(0)
+    inst_x4_24 = fixed_def.fixed_mul(x4_24, x2, x2_24, shift=f + g)
 
     @always_comb
     def logic():
-        """Second-order Taylor expansion of the exponential function around 0."""
-        y.next = (1 << fixed_def.f) + x + (x2 >> 1) + x3_6
+        """Fourth-order Taylor expansion of the exponential function around 0."""
+        y.next = one + x + x2_t + x4_24
 
     return instances()
 
 
-def ExpSeq(x, y, clock, reset, fixed_def):
+def ExpSeq(x, y, clock, reset, fixed_def, order=None):
     """Sequential wrapper for the exponential function."""
 
     y_comb = fixed_def.make_signal(0)
-    exp_inst = ExpComb(x, y_comb, fixed_def)
+    exp_inst = ExpComb(x, y_comb, fixed_def, order)
 
     @always_seq(clock.posedge, reset=reset)
     def reg_exp():
@@ -75,22 +236,44 @@ def ExpSeq(x, y, clock, reset, fixed_def):
     return instances()
 
 
-# Globals to contain simulation data for plotting.
-x_vals, y_vals, relerr_vals = [], [], []
+# Globals to contain simulation data for plotting, preallocated by
+# exp_test_bench, and the number of samples recorded so far.
+x_ints, y_ints = array('l'), array('l')
+n_samples = [0]
+
 
+def taylor_reference(x, order):
+    """Floating-point Taylor expansion of exp(x), Estrin-grouped as in ExpComb."""
+    c = TAYLOR_COEFFS
+    x = np.asarray(x, dtype=float)
+    x2 = x * x
 
-def exp_test_bench(N):
+    high = c[2] if order == 2 else c[2] + x * c[3]
+    y = (c[0] + c[1] * x) + x2 * high
+    if order == 4:
+        y = y + x2 * (x2 * c[4])
+    return y
+
+
+def exp_test_bench(fixed_def, order):
     reset = ResetSignal(1, active=0, async=True)
 
-    fixed_def = FixedDef(1, N)
+    N = fixed_def.f
     y = fixed_def.make_signal(0)
     x = fixed_def.make_signal(0)
     clock = Signal(bool(0))
 
-    exp_inst = ExpSeq(x, y, clock, reset, fixed_def)
+    exp_inst = ExpSeq(x, y, clock, reset, fixed_def, order)
 
     period = delay(1)
 
+    # The stimulus drives 2 * (1 << N) - 1 inputs, plus one sample of the
+    # initial state before the first input arrives.
+    M = 2 * (1 << N)
+    x_ints[:] = array('l', [0]) * M
+    y_ints[:] = array('l', [0]) * M
+    n_samples[0] = 0
+
     @always(period)
     def clock_gen():
         clock.next = not clock
@@ -108,49 +291,72 @@ def exp_test_bench(N):
         while 1:
             yield clock.posedge
             yield delay(1)
-            xf = fixed_def.to_float(x.val)
-            yf = fixed_def.to_float(y.val)
-            ygold = math.exp(fixed_def.to_float(x.val))
-            relerr = (yf - ygold) / ygold
-            print "x = %f (%s), test y = %f (%s), gold y = %f, relative err = %f" % (
-            xf, bin(x.val), yf, bin(y.val), ygold, relerr)
-
-            x_vals.append(xf)
-            y_vals.append(yf)
-            relerr_vals.append(relerr)
+            # Only record the raw samples here; the reference is computed in
+            # bulk after the simulation finishes.
+            i = n_samples[0]
+            x_ints[i] = int(x.val)
+            y_ints[i] = int(y.val)
+            n_samples[0] = i + 1
 
     return instances()
 
 
-def convert():
-    fixed_def = FixedDef(1, 6)
+def convert(f, order):
+    fixed_def = FixedDef(1, f)
 
     X = fixed_def.make_signal(0)
     Y = fixed_def.make_signal(0)
-    toVerilog(ExpComb, X, Y, fixed_def)
+    toVerilog(ExpComb, X, Y, fixed_def, order)
 
     clock = Signal(bool())
     reset = ResetSignal(1, active=0, async=True)
-    toVerilog(ExpSeq, X, Y, clock, reset, fixed_def)
+    toVerilog(ExpSeq, X, Y, clock, reset, fixed_def, order)
+
+
+def simulate(N, order, verbose=False):
+    fixed_def = FixedDef(1, N-1)
 
+    # Resolve the default once, so the hardware and taylor_reference agree.
+    if order is None:
+        order = _choose_order(fixed_def.f)
 
-def simulate():
-    N = 6
-    tb = traceSignals(exp_test_bench, N-1)
+    # VCD tracing dominates simulation time, so it is opt-in.
+    if os.environ.get("MYHDL_TRACE"):
+        tb = traceSignals(exp_test_bench, fixed_def, order)
+    else:
+        tb = exp_test_bench(fixed_def, order)
     sim = Simulation(tb)
     sim.run()
 
     # Sort the data in order of increasing x.
-    global x_vals, y_vals, relerr_vals
-    data = zip(x_vals, y_vals, relerr_vals)
-    data.sort()
-    x_vals, y_vals, relerr_vals = zip(*data)
+    x_raw = np.frombuffer(x_ints, dtype=np.int_, count=n_samples[0])
+    y_raw = np.frombuffer(y_ints, dtype=np.int_, count=n_samples[0])
+    idx = np.argsort(x_raw, kind="mergesort")
+    x_raw, y_raw = x_raw[idx], y_raw[idx]
+
+    # Convert to floating point and compare against the reference in bulk.
+    x_vals = x_raw * fixed_def.inv_scale
+    y_vals = y_raw * fixed_def.inv_scale
+    gold_vals = np.exp(x_vals)
+    relerr_vals = (y_vals - gold_vals) / gold_vals
+
+    if verbose:
+        lines = ["x = %f (%s), test y = %f (%s), gold y = %f, relative err = %f" % (
+                 xf, bin(xr), yf, bin(yr), ygold, relerr)
+                 for xr, xf, yr, yf, ygold, relerr in zip(x_raw, x_vals, y_raw, y_vals, gold_vals, relerr_vals)]
+        sys.stdout.write("\n".join(lines) + "\n")
+
+    # Separate the fixed-point rounding error from the Taylor truncation error.
+    taylor_vals = taylor_reference(x_vals, order)
+    print "order %d: max rounding error = %.2f LSB, max truncation error = %f" % (
+        order, np.max(np.abs(y_raw - taylor_vals * fixed_def.scale)), np.max(np.abs(taylor_vals - gold_vals)))
 
     import matplotlib.pyplot as plt
     # Display output vs. actual exp function.
     plt.figure()
     plt.plot(x_vals, y_vals, "r.-", label= "exp_%d(x)" % N)
-    plt.plot(x_vals, [math.exp(x) for x in x_vals], "g.-", label="exp(x)")
+    plt.plot(x_vals, gold_vals, "g.-", label="exp(x)")
+    plt.plot(x_vals, taylor_vals, "b-", label="taylor_%d(x)" % order)
     plt.xlabel("x")
     plt.ylabel("y")
     plt.grid()
@@ -168,6 +374,21 @@ def simulate():
 
 
 if __name__ == '__main__':
-    convert()
-    simulate()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fixed-point exp() in MyHDL.")
+    parser.add_argument("--bits", type=int, default=6,
+                        help="simulate and plot the 1.(BITS-1) fixed-point format, i.e. "
+                             "with BITS-1 bits after the radix point (default: 6)")
+    parser.add_argument("--verilog-frac-bits", type=int, default=6,
+                        help="bits after the radix point in the generated Verilog (default: 6)")
+    parser.add_argument("--order", type=int, choices=(2, 3, 4), default=None,
+                        help="order of the Taylor expansion (default: chosen from the "
+                             "number of bits after the radix point)")
+    parser.add_argument("--verbose", action="store_true",
+                        help="print the result for every simulated input")
+    args = parser.parse_args()
+
+    convert(args.verilog_frac_bits, args.order)
+    simulate(args.bits, args.order, args.verbose)
 
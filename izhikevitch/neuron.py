@@ -6,9 +6,19 @@ Simple Model of Spiking Neurons
 IEEE TRANSACTIONS ON NEURAL NETWORKS, VOL. 14, NO. 6, NOVEMBER 2003
 """
 
+import os
+
+import numpy as np
 import pylab
 from myhdl import *
 
+try:
+    from numba import njit
+except ImportError:
+    # Without numba the fast model below still works, just as plain Python.
+    def njit(*args, **kwargs):
+        return lambda func: func
+
 ################################################################################
 # Low-budget fixed-point implementation.
 
@@ -18,9 +28,12 @@ def fixed_mul(x, y, Fshift):
     return (x * y) >> Fshift
 
 
-def to_fixed(x, Fshift):
-    """Convert a floating point input to the nearest fixed-point representation."""
-    return int(x * (1 << Fshift))
+def to_fixed(x, Fshift, scale=None):
+    """Convert a floating point input to the nearest fixed-point representation.
+    scale: precomputed 1 << Fshift, if available"""
+    if scale is None:
+        scale = 1 << Fshift
+    return int(x * scale)
 
 
 def to_float(x, Fshift):
@@ -31,37 +44,63 @@ def to_float(x, Fshift):
 
 
 ################################################################################
-# Izhikevitch model derivatives.
+# Izhikevitch model constants, shared by neuron_module and simulate_neuron_numba.
+
+# dv/dt = V2_COEFF * v^2 + V_COEFF * v + V_CONST - u + I
+V2_COEFF = 0.04
+V_COEFF = 5
+V_CONST = 140
 
-def compute_dv(I, u, v, dt, Fshift):
-    """Compute (dv/dt) * dt."""
-    c1 = to_fixed(0.04, Fshift)
-    c2 = to_fixed(5, Fshift)
-    c3 = to_fixed(140, Fshift)
+# Membrane potential (mV) above which the neuron spikes and is reset.
+SPIKE_THRESHOLD = 30.0
 
-    v2 = fixed_mul(v, v, Fshift)
-    return fixed_mul(dt,
-                    fixed_mul(c1, v2, Fshift) + fixed_mul(c2, v, Fshift) + c3 - u + I,
-                    Fshift)
+################################################################################
 
 
-def compute_du(u, v, a, b, dt, Fshift):
-    """Compute (du/dt) * dt."""
-    b_v = fixed_mul(b, v, Fshift)
-    dt_a = fixed_mul(dt, a, Fshift)
-    return fixed_mul(dt_a, b_v - u, Fshift)
+# Half-period of the test bench clock, and the (duration, input current) phases
+# of the test bench stimulus, in simulator time units.
+half_period = 50
+stimulus_phases = ((10000, 0.0), (100000, 10.0), (10000, 0.0))
 
-################################################################################
 
-# Containers for matplotlib data.
-t_values = []
-u_values = []
-v_values = []
-I_values = []
-out_values = []
+def stimulus_cycles():
+    """Number of rising clock edges over the test bench stimulus."""
+    return sum(duration for duration, _ in stimulus_phases) // (2 * half_period) + 1
 
 
-def neuron_module(clk, reset, I, output, a, b, c, d, dt, Fshift):
+class StateRecorder:
+    """
+    Raw fixed-point state of a neuron_module, recorded on each rising clock
+    edge: one row each for t, u, v, I and the output spike.
+    n_cycles: expected number of samples; the buffer grows if more are recorded
+    """
+
+    def __init__(self, n_cycles):
+        self.buf = np.empty((5, max(n_cycles, 1)), dtype=np.int64)
+        self.n = 0
+
+    def record(self, t, u, v, I, output):
+        i = self.n
+        if i == self.buf.shape[1]:
+            self.buf = np.concatenate((self.buf, np.empty_like(self.buf)), axis=1)
+        buf = self.buf
+        buf[0, i] = t
+        buf[1, i] = int(u)
+        buf[2, i] = int(v)
+        buf[3, i] = int(I)
+        buf[4, i] = bool(output)
+        self.n = i + 1
+
+    def samples(self):
+        """Return the rows t, u, v, I and output for the samples recorded so far."""
+        return self.buf[:, :self.n]
+
+
+def _no_record(t, u, v, I, output):
+    pass
+
+
+def neuron_module(clk, reset, I, output, a, b, c, d, dt, Fshift, recorder=None):
     """
     Izhikevitch neuron behavior.
     I: input current
@@ -69,44 +108,114 @@ def neuron_module(clk, reset, I, output, a, b, c, d, dt, Fshift):
     a, b, c, d: Izhikevitch neuron parameters
     dt: milliseconds of simulated time per clock
     Fshift: number of bits after the decimal
+    recorder: optional StateRecorder to log the state on every clock
     """
-    a_fix = to_fixed(a, Fshift)
-    b_fix = to_fixed(b, Fshift)
-    c_fix = to_fixed(c, Fshift)
-    d_fix = to_fixed(d, Fshift)
-    dt_fix = to_fixed(dt, Fshift)
+    scale = 1 << Fshift
+
+    a_fix = to_fixed(a, Fshift, scale)
+    b_fix = to_fixed(b, Fshift, scale)
+    c_fix = to_fixed(c, Fshift, scale)
+    d_fix = to_fixed(d, Fshift, scale)
+    dt_fix = to_fixed(dt, Fshift, scale)
 
-    threshold = to_fixed(30.0, Fshift)
+    c1_fix = to_fixed(V2_COEFF, Fshift, scale)
+    c2_fix = to_fixed(V_COEFF, Fshift, scale)
+    c3_fix = to_fixed(V_CONST, Fshift, scale)
+
+    threshold = to_fixed(SPIKE_THRESHOLD, Fshift, scale)
+
+    # dt * a is constant, so fold it once here rather than on every clock.
+    dt_a_fix = fixed_mul(dt_fix, a_fix, Fshift)
 
     max_val = 1 << (Fshift + 7)
 
+    record = _no_record if recorder is None else recorder.record
+
     v = Signal(intbv(c_fix, min=-max_val, max=max_val))
     u = Signal(intbv(fixed_mul(v, b_fix, Fshift), min=-max_val, max=max_val))
 
     @always_seq(clk.posedge, reset=reset)
     def neuron():
-        dv = compute_dv(I, u, v, dt_fix, Fshift)
+        # (dv/dt) * dt, with c1 * v^2 + c2 * v + c3 in Horner form.  Note that
+        # this leaves no v^2 product; a du variant that needs v^2 should compute
+        # it once here and share it rather than add a second v * v multiplier.
+        dv = fixed_mul(dt_fix,
+                       fixed_mul(fixed_mul(c1_fix, v, Fshift) + c2_fix, v, Fshift) + c3_fix - u + I,
+                       Fshift)
+
+        # (du/dt) * dt
+        du = fixed_mul(dt_a_fix, fixed_mul(b_fix, v, Fshift) - u, Fshift)
+
         updated_v = v + dv
-        if updated_v > threshold:
-            v.next = c_fix
-            u.next = u + d_fix
-            output.next = True
-        else:
-            du = compute_du(u, v, a_fix, b_fix, dt_fix, Fshift)
-            v.next = updated_v
-            u.next = u + du
-            output.next = False
 
-        t_values.append(now() * 1.0e-3)
-        u_values.append(to_float(u, Fshift))
-        v_values.append(to_float(v, Fshift))
-        I_values.append(to_float(I, Fshift))
-        out_values.append(output)
+        # Compute both the spike and no-spike updates and select between them.
+        spike = updated_v > threshold
+        v.next = c_fix if spike else updated_v
+        u.next = (u + d_fix) if spike else (u + du)
+        output.next = spike
+
+        record(now(), u, v, I, output)
 
     return neuron
 
 
-def iz_test_bench(a, b, c, d, dt, Fshift):
+@njit(cache=True)
+def simulate_neuron_numba(I_schedule, a, b, c, d, dt, Fshift, n_cycles):
+    """
+    Fast model of neuron_module outside of the MyHDL simulator, for long runs
+    and parameter sweeps.  neuron_module remains the design to convert to HDL.
+    I_schedule: fixed-point input current for each clock
+    a, b, c, d, dt, Fshift: as for neuron_module
+    n_cycles: number of clocks to simulate
+    Returns arrays of the v, u and output registers after each clock, bit-exact
+    with neuron_module: feeding it the I values that a StateRecorder logs from
+    iz_test_bench reproduces the recorded v, u and output sequences exactly.
+    """
+    scale = 1 << Fshift
+
+    a_fix = int(a * scale)
+    b_fix = int(b * scale)
+    c_fix = int(c * scale)
+    d_fix = int(d * scale)
+    dt_fix = int(dt * scale)
+
+    # Same conversions as to_fixed, which numba cannot call.
+    c1_fix = int(V2_COEFF * scale)
+    c2_fix = int(V_COEFF * scale)
+    c3_fix = int(V_CONST * scale)
+
+    threshold = int(SPIKE_THRESHOLD * scale)
+
+    dt_a_fix = (dt_fix * a_fix) >> Fshift
+
+    v_out = np.empty(n_cycles, dtype=np.int64)
+    u_out = np.empty(n_cycles, dtype=np.int64)
+    spike_out = np.empty(n_cycles, dtype=np.bool_)
+
+    v = c_fix
+    u = (v * b_fix) >> Fshift
+    for i in range(n_cycles):
+        inner = ((c1_fix * v) >> Fshift) + c2_fix
+        dv = (dt_fix * (((inner * v) >> Fshift) + c3_fix - u + I_schedule[i])) >> Fshift
+        du = (dt_a_fix * (((b_fix * v) >> Fshift) - u)) >> Fshift
+
+        updated_v = v + dv
+        spike = updated_v > threshold
+        if spike:
+            v = c_fix
+            u = u + d_fix
+        else:
+            v = updated_v
+            u = u + du
+
+        v_out[i] = v
+        u_out[i] = u
+        spike_out[i] = spike
+
+    return v_out, u_out, spike_out
+
+
+def iz_test_bench(a, b, c, d, dt, Fshift, recorder=None):
     max_val = 1 << (Fshift + 7)
 
     I = Signal(intbv(0, min=-max_val, max=max_val))
@@ -115,68 +224,87 @@ def iz_test_bench(a, b, c, d, dt, Fshift):
     clk = Signal(bool(0))
     reset = ResetSignal(1, active=0, async=True)
 
-    neuron_instance = neuron_module(clk, reset, I, output, a, b, c, d, dt, Fshift)
+    neuron_instance = neuron_module(clk, reset, I, output, a, b, c, d, dt, Fshift, recorder)
 
-    @always(delay(50))
+    @always(delay(half_period))
     def clkgen():
         clk.next = not clk
 
     @instance
     def stimulus():
-        I.next = 0
-        yield delay(10000)
-        I.next = to_fixed(10.0, Fshift)
-        yield delay(100000)
-        I.next = 0
-        yield delay(10000)
-
-        pylab.figure(1)
-        pylab.subplot(311)
-        pylab.title("MyHDL Izhikevitch neuron (chattering)")
-        pylab.plot(t_values, v_values, label="v")
-        pylab.ylabel('membrane potential (mv)')
-        pylab.grid()
-        pylab.subplot(312)
-        pylab.plot(t_values, u_values, label="u")
-        pylab.ylabel("recovery variable")
-        pylab.grid()
-        pylab.subplot(313)
-        pylab.plot(t_values, I_values, label="I")
-        pylab.grid()
-        pylab.ylabel("input current")
-        pylab.xlabel("time (usec)")
-        pylab.show()
+        for duration, current in stimulus_phases:
+            I.next = to_fixed(current, Fshift)
+            yield delay(duration)
 
         raise StopSimulation
 
     return clkgen, stimulus, neuron_instance
 
 
-# Uncomment definitions of a, b, c, d to choose different neuron types.
-
-# Regular spiking
-#a, b, c, d = 0.02, 0.2, -65.0, 8.0
-
-# Fast spiking
-#a, b, c, d = 0.1, 0.2, -65.0, 2.0
-
-#intrinsically bursting
-#a, b, c, d =0.02, 0.2, -55.0, 4.0
-
-# chattering
-a, b, c, d = 0.02, 0.2, -50.0, 2.0
-
-# low-threshold spiking
-#a, b, c, d = 0.02, 0.25, -65, 2.0
-
-# thalamo-cortical
-#a, b, c, d = 0.02, 0.25, -65.0, 0.05
-
-# resonator
-#a, b, c, d = 0.1, 0.26, -65.0, 2.0
-
-# Time step (msec in simulated time per clock).
-dt = 0.2
-
-sim = Simulation(traceSignals(iz_test_bench, a, b, c, d, dt, 11))
-sim.run()
+def plot_results(recorder, Fshift):
+    """Plot the state recorded by neuron_module during the simulation."""
+    inv_scale = 1.0 / (1 << Fshift)
+
+    t_raw, u_raw, v_raw, I_raw, out_raw = recorder.samples()
+    t_values = t_raw * 1.0e-3
+    u_values = u_raw * inv_scale
+    v_values = v_raw * inv_scale
+    I_values = I_raw * inv_scale
+
+    pylab.figure(1)
+    pylab.subplot(311)
+    pylab.title("MyHDL Izhikevitch neuron (chattering)")
+    pylab.plot(t_values, v_values, label="v")
+    pylab.ylabel('membrane potential (mv)')
+    pylab.grid()
+    pylab.subplot(312)
+    pylab.plot(t_values, u_values, label="u")
+    pylab.ylabel("recovery variable")
+    pylab.grid()
+    pylab.subplot(313)
+    pylab.plot(t_values, I_values, label="I")
+    pylab.grid()
+    pylab.ylabel("input current")
+    pylab.xlabel("time (usec)")
+    pylab.show()
+
+
+if __name__ == '__main__':
+    # Uncomment definitions of a, b, c, d to choose different neuron types.
+
+    # Regular spiking
+    #a, b, c, d = 0.02, 0.2, -65.0, 8.0
+
+    # Fast spiking
+    #a, b, c, d = 0.1, 0.2, -65.0, 2.0
+
+    #intrinsically bursting
+    #a, b, c, d =0.02, 0.2, -55.0, 4.0
+
+    # chattering
+    a, b, c, d = 0.02, 0.2, -50.0, 2.0
+
+    # low-threshold spiking
+    #a, b, c, d = 0.02, 0.25, -65, 2.0
+
+    # thalamo-cortical
+    #a, b, c, d = 0.02, 0.25, -65.0, 0.05
+
+    # resonator
+    #a, b, c, d = 0.1, 0.26, -65.0, 2.0
+
+    # Time step (msec in simulated time per clock).
+    dt = 0.2
+
+    # Set MYHDL_TRACE to dump a VCD trace of the simulation (much slower).  The
+    # trace holds only clk, reset, I, output and the neuron's v and u registers;
+    # the fixed-point parameters are plain ints and are never dumped.
+    recorder = StateRecorder(stimulus_cycles())
+    if os.environ.get("MYHDL_TRACE"):
+        tb = traceSignals(iz_test_bench, a, b, c, d, dt, 11, recorder)
+    else:
+        tb = iz_test_bench(a, b, c, d, dt, 11, recorder)
+
+    sim = Simulation(tb)
+    sim.run()
+    plot_results(recorder, 11)